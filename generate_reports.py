@@ -1,65 +1,223 @@
+import io
 import os
+import re
+import sys
 import requests
 import time
+import random
 import gzip
 import shutil
 import json
+import hashlib
+import zlib
 import datetime
+import threading
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+from urllib3.util.retry import Retry
+
+# Use orjson for faster JSON encoding and parsing when it is installed
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+    def _json_dumps(obj):
+        return json.dumps(obj).encode()
+
+# Use ISA-L accelerated gzip decompression when python-isal is installed
+try:
+    from isal import igzip_threaded, isal_zlib
+    _GZIP_ERRORS = (OSError, EOFError, zlib.error, isal_zlib.error)
+except ImportError:
+    igzip_threaded = None
+    _GZIP_ERRORS = (OSError, EOFError, zlib.error)
+
+# Use rapidgzip to decompress large archives on disk across all cores when it is installed
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Function to read a whole-number setting, falling back to the default when it isn't valid
+def _int_env(name, default, requirement, minimum=None):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+        if minimum is None or number >= minimum:
+            return number
+    except ValueError:
+        pass
+    print(f"Ignoring {name}={value}: it must be {requirement}. Using {default}.")
+    return default
+
 # Get environment variables
 PRIMARY_ORG_ID = os.getenv('PRIMARY_ORG_ID')
 CIRCLE_TOKEN = os.getenv('CIRCLE_TOKEN')
 START_DATE = os.getenv('START_DATE')  # Format: "2024-11-01T09:00:00Z"
 END_DATE = os.getenv('END_DATE')      # Format: "2024-11-01T09:00:00Z"
+START_DATES = os.getenv('START_DATES')  # Comma-separated, to request several timeframes in one run
+END_DATES = os.getenv('END_DATES')      # Comma-separated, one per entry in START_DATES
+KEEP_GZ = os.getenv('KEEP_GZ', '0') == '1'  # Also keep the compressed .csv.gz files
+SHARED_ORGS_TTL = _int_env('SHARED_ORGS_TTL', 300, "a whole number of seconds")  # Seconds to reuse the cached org list
+REFRESH_ORGS = os.getenv('REFRESH_ORGS', '0') == '1'  # Ignore the cached org list
+VERBOSE = os.getenv('VERBOSE', '0') == '1'  # Print the organization table even when not on a terminal
+DEBUG = os.getenv('DEBUG', '0') == '1'  # Save full unexpected API responses to usage_reports
+# Bytes per read/write when downloading and decompressing. 256 KiB - 1 MiB works best for gzip;
+# values above 4 MiB mostly add memory per download thread without improving throughput
+CHUNK_SIZE = _int_env('CHUNK_SIZE', 1 << 20, "a positive number of bytes", minimum=1)
 
 # Create directory for usage reports
 REPORT_DIR = 'usage_reports'
 os.makedirs(REPORT_DIR, exist_ok=True)
+CACHE_DIR = os.path.join(REPORT_DIR, '.cache')
 
-# Function to get all organizations on the shared plan
-def get_shared_orgs(org_id, circle_token):
+# Request headers, built once instead of on every call
+_HEADERS = MappingProxyType({
+    "Circle-Token": CIRCLE_TOKEN,
+    "Accept": "application/json"
+})
+# Download URLs are pre-signed, so unset the session's CircleCI token and JSON Accept header
+_DOWNLOAD_HEADERS = MappingProxyType({
+    "Circle-Token": None,
+    "Accept": None
+})
+# Export job requests send a pre-encoded JSON body
+_POST_HEADERS = MappingProxyType({
+    "Content-Type": "application/json"
+})
+
+# Maximum number of files downloaded concurrently, and of completed jobs downloaded at once
+MAX_DOWNLOAD_WORKERS = 8
+MAX_DOWNLOAD_JOBS = 4
+
+# Pooled connections are kept per host, so this is sized for the download host alone: one per
+# download thread, so concurrent downloads always reuse a warm connection instead of opening
+# and discarding extras. API calls to circleci.com use a separate pool
+POOL_MAXSIZE = MAX_DOWNLOAD_JOBS * MAX_DOWNLOAD_WORKERS
+
+# Shared HTTP session so every API call and download reuses pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.headers.update(_HEADERS)
+# Transient failures are retried by urllib3 with exponential backoff, honoring Retry-After.
+# Only idempotent methods are retried on read errors or bad statuses, so the export job
+# POST (which counts against CircleCI's daily limit) is only retried if it failed to connect.
+_retry = Retry(
+    total=3,
+    connect=3,
+    read=3,
+    backoff_factor=1.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+    raise_on_status=False
+)
+_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=POOL_MAXSIZE, max_retries=_retry)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+# Connect and read timeouts (seconds) for all requests
+TIMEOUT = (5, 60)
+DOWNLOAD_TIMEOUT = (5, 120)
+
+# Archives at least this large are decompressed in parallel with rapidgzip, which splits the
+# stream into 4 MiB chunks; smaller ones finish faster on a single core
+PARALLEL_GZIP_MIN_SIZE = 32 << 20
+PARALLEL_GZIP_CHUNK_SIZE = 4 << 20
+
+# Parallel unzips already use every core, so several jobs unzipping at once run one at a time
+# instead of starting a full set of decoder threads each
+_parallel_gzip_lock = threading.Lock()
+
+# Job status polling: exponential backoff from a short initial delay, capped at 2 minutes,
+# giving up once a job has been polled for 2 hours in total
+POLL_INITIAL_DELAY = 2
+POLL_BACKOFF_FACTOR = 1.7
+POLL_MAX_DELAY = 120
+POLL_TIMEOUT = 2 * 60 * 60
+
+# Maximum number of bytes of an unexpected API response to print
+DEBUG_PRINT_LIMIT = 4096
+
+# Expected date format, e.g. 2024-11-01T09:00:00Z
+_DATE_RE = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}Z')
+
+# Function to check a date matches the expected format and is a real calendar date and time
+def _is_valid_date(date):
+    if not _DATE_RE.fullmatch(date):
+        return False
+    try:
+        datetime.datetime.strptime(date, '%Y-%m-%dT%H:%M:%SZ')
+    except ValueError:
+        return False
+    return True
+
+# Function to get the cache file path for an organization's shared plan list
+def _shared_orgs_cache_path(org_id):
+    key = hashlib.sha1(org_id.encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"shared_orgs_{key}.json")
+
+# Function to load the cached shared plan list if it is still fresh
+def _load_cached_orgs(org_id):
+    if REFRESH_ORGS or SHARED_ORGS_TTL <= 0:
+        return None
+    try:
+        with open(_shared_orgs_cache_path(org_id), 'rb') as file:
+            cached = _json_loads(file.read())
+        if time.time() - cached['ts'] < SHARED_ORGS_TTL and isinstance(cached['orgs'], list):
+            return cached['orgs']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+# Function to save the shared plan list to the cache
+def _save_cached_orgs(org_id, orgs):
+    cache_path = _shared_orgs_cache_path(org_id)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Write to a temporary file first so a concurrent run never reads a partial cache
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(_json_dumps({"ts": time.time(), "orgs": orgs}))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Warning: unable to cache organization list: {e}")
+
+# Function to fetch all organizations on the shared plan from the API
+def _fetch_shared_orgs(org_id):
     print(f"Fetching organizations on the shared plan for {org_id}...")
     url = f"https://circleci.com/private/orgs/{org_id}/plan/shares-for"
     
-    headers = {
-        "Circle-Token": circle_token,
-        "Accept": "application/json"
-    }
-    
     try:
-        response = requests.get(url, headers=headers)
+        response = SESSION.get(url, timeout=TIMEOUT)
         
         # Check if request was successful
         if response.status_code == 200:
-            # Parse the JSON response
-            data = response.json()
+            # Parse the JSON response straight from the raw bytes
+            data = _json_loads(response.content)
             
             # Based on the actual response format (contains 'orgs' key)
             if 'orgs' in data and isinstance(data['orgs'], list):
-                orgs = data['orgs']
-                
-                # Print summary information
-                print(f"\nFound {len(orgs)} organizations on the shared plan.")
-                
-                # Extract and display organization information
-                print("\nOrganizations on the shared plan:")
-                print(f"{'#':<4} {'Name':<30} {'VCS Type':<12} {'Organization ID'}")
-                print("-" * 75)
-                
-                for i, org in enumerate(orgs, 1):
-                    org_id = org.get('id', 'Unknown ID')
-                    org_name = org.get('name', 'Unknown Name')
-                    vcs_type = org.get('vcs_type', 'Unknown')
-                    print(f"{i:<4} {org_name:<30} {vcs_type:<12} {org_id}")
-                
-                return orgs
+                return data['orgs']
             else:
                 print("Unexpected response format. Response doesn't contain 'orgs' list.")
-                print("Full response:", json.dumps(data, indent=2))
+                # Print only the start of the raw body so a huge payload can't stall the error path
+                print("Full response (truncated):", response.content[:DEBUG_PRINT_LIMIT].decode(errors='replace'))
+                if DEBUG:
+                    debug_path = os.path.join(REPORT_DIR, f"shared_orgs_response_{org_id}.json")
+                    with open(debug_path, 'wb') as file:
+                        file.write(response.content)
+                    print(f"Full response saved to {debug_path}")
+                else:
+                    print("Set DEBUG=1 to save the full response.")
                 return []
         else:
             print(f"Error: API request failed with status code {response.status_code}")
@@ -69,19 +227,45 @@ def get_shared_orgs(org_id, circle_token):
     except requests.exceptions.RequestException as e:
         print(f"Request error: {str(e)}")
     except json.JSONDecodeError:
-        print(f"Error: Unable to parse JSON response: {response.text}")
+        print(f"Error: Unable to parse JSON response: {response.text[:DEBUG_PRINT_LIMIT]}")
     except Exception as e:
         print(f"Unexpected error: {str(e)}")
     
     return []
 
+# Function to display the organizations on the shared plan as a table
+def _print_orgs_table(orgs):
+    lines = [
+        "\nOrganizations on the shared plan:",
+        f"{'#':<4} {'Name':<30} {'VCS Type':<12} {'Organization ID'}",
+        "-" * 75
+    ]
+    for i, org in enumerate(orgs, 1):
+        org_id = org.get('id', 'Unknown ID')
+        org_name = org.get('name', 'Unknown Name')
+        vcs_type = org.get('vcs_type', 'Unknown')
+        lines.append(f"{i:<4} {org_name:<30} {vcs_type:<12} {org_id}")
+    
+    # Write the whole table at once instead of one print per organization
+    sys.stdout.write("\n".join(lines) + "\n")
+
+# Function to get all organizations on the shared plan
+def get_shared_orgs(org_id):
+    orgs = _load_cached_orgs(org_id)
+    if orgs is not None:
+        print(f"Using cached list of {len(orgs)} organizations on the shared plan for {org_id}.")
+        print("Set REFRESH_ORGS=1 to fetch it again.")
+        return orgs
+    
+    orgs = _fetch_shared_orgs(org_id)
+    if orgs:
+        print(f"\nFound {len(orgs)} organizations on the shared plan.")
+        _save_cached_orgs(org_id, orgs)
+    return orgs
+
 # Function to create a usage export job
-def create_usage_export_job(org_id, circle_token, start_date, end_date, shared_org_ids=None):
+def create_usage_export_job(org_id, start_date, end_date, shared_org_ids=None):
     url = f"https://circleci.com/api/v2/organizations/{org_id}/usage_export_job"
-    headers = {
-        "Circle-Token": circle_token,
-        "Content-Type": "application/json"
-    }
     
     # If shared_org_ids is not provided, use the org_id itself
     if shared_org_ids is None:
@@ -96,98 +280,222 @@ def create_usage_export_job(org_id, circle_token, start_date, end_date, shared_o
     print(f"Creating export job for timeframe: {start_date} to {end_date}")
     print(f"Including {len(shared_org_ids)} organizations in the report")
     
-    response = requests.post(url, headers=headers, json=data)
+    response = SESSION.post(url, headers=_POST_HEADERS, data=_json_dumps(data), timeout=TIMEOUT)
     
     if response.status_code != 201:
         print(f"Failed to create usage export job: {response.text}")
         return None
     
-    return response.json().get('usage_export_job_id')
+    return _json_loads(response.content).get('usage_export_job_id')
+
+# Function to read a Retry-After header given in seconds, if the server sent one
+# Anything else (HTTP-dates, negative, fractional or non-finite values) falls back to normal backoff
+def _retry_after(response):
+    value = response.headers.get('Retry-After', '').strip()
+    if value.isascii() and value.isdigit():
+        return int(value)
+    return None
 
 # Function to check the status of the usage export job
-def check_job_status(org_id, circle_token, job_id):
+# Returns the job status (or None on failure) and the server's requested Retry-After delay, if any
+def check_job_status(org_id, job_id):
     url = f"https://circleci.com/api/v2/organizations/{org_id}/usage_export_job/{job_id}"
-    headers = {
-        "Circle-Token": circle_token
-    }
-    response = requests.get(url, headers=headers)
+    response = SESSION.get(url, timeout=TIMEOUT)
     
     if response.status_code != 200:
         print(f"Failed to get job status: {response.text}")
-        return None
+        return None, None
     
-    return response.json()
-
-# Function to download files from URLs
-def download_files(download_urls, start_date, end_date, filename_prefix):
-    max_retries = 3
-    downloaded_files = []
-    
-    for url in download_urls:
-        print(f"Downloading {url}...")
-        for attempt in range(1, max_retries + 1):
-            response = requests.get(url, allow_redirects=True)
-            if response.status_code == 200:
-                # Create a structured filename
-                date_part = f"{start_date[:10]}_{end_date[:10]}"
-                filename = f"{filename_prefix}_{date_part}.csv.gz"
-                file_path = os.path.join(REPORT_DIR, filename)
-                
-                # Save the file
-                with open(file_path, 'wb') as file:
-                    file.write(response.content)
-                print(f"Downloaded {file_path}")
-                downloaded_files.append(file_path)
-                break  # Exit retry loop on success
-            else:
-                print(f"Attempt {attempt}/{max_retries} failed to download {url}, Status Code: {response.status_code}")
-                if attempt == max_retries:
-                    print(f"Failed to download {url} after {max_retries} attempts.")
+    return _json_loads(response.content), _retry_after(response)
+
+# Function to compute how long to wait before the next status check
+# A Retry-After from the server only sets a minimum, so the backoff keeps growing regardless
+def _poll_delay(attempt, retry_after=None):
+    delay = max(retry_after or 0, POLL_INITIAL_DELAY * POLL_BACKOFF_FACTOR ** attempt + random.uniform(0, 1))
+    return min(delay, POLL_MAX_DELAY)
+
+# Per-thread CHUNK_SIZE transfer buffer, allocated once and reused for every copy made on that thread
+_buffers = threading.local()
+
+def _transfer_buffer():
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None:
+        buf = _buffers.buf = bytearray(CHUNK_SIZE)
+    return buf
+
+# Function to copy a stream into a file through a reusable buffer instead of allocating per chunk
+def _copy_readinto(src, dst, buf):
+    view = memoryview(buf)
+    while True:
+        n = src.readinto(buf)
+        if not n:
+            break
+        dst.write(view[:n])
+
+# Function to open a gzip stream for reading, preferring ISA-L over the stdlib gzip module
+def _open_gzip(fileobj):
+    if igzip_threaded is not None:
+        # Inflate on a background thread so decompression overlaps with reading and writing
+        return igzip_threaded.open(fileobj, 'rb', threads=1, block_size=CHUNK_SIZE)
+    return gzip.GzipFile(fileobj=fileobj)
+
+# Readable stream that replays already consumed bytes before the rest of the source stream
+class _PrefixedStream(io.RawIOBase):
+    def __init__(self, prefix, stream):
+        self._prefix = prefix
+        self._stream = stream
     
-    return downloaded_files
+    def readable(self):
+        return True
+    
+    def readinto(self, b):
+        if self._prefix:
+            n = min(len(b), len(self._prefix))
+            b[:n] = self._prefix[:n]
+            self._prefix = self._prefix[n:]
+            return n
+        return self._stream.readinto(b)
+
+# Function to check the gzip magic number at the start of a response stream
+# Returns a stream that still yields every byte, or None if the data is not gzipped
+def _peek_gzip_magic(raw):
+    magic = raw.read(2)
+    if magic != b'\x1f\x8b':
+        return None
+    return _PrefixedStream(magic, raw)
 
-# Function to validate file format
-def validate_file(file_path):
+# Function to write a gzip stream to a file unchanged
+def _write_gzip(stream, file):
+    _copy_readinto(stream, file, _transfer_buffer())
+
+# Function to decompress a gzip stream into a file as it arrives, so the .csv.gz never touches disk
+def _write_unzipped(stream, file):
+    with _open_gzip(stream) as f_in:
+        _copy_readinto(f_in, file, _transfer_buffer())
+
+# Function to stream a single URL to disk through sink, one of _write_gzip or _write_unzipped
+def _fetch_one(session, url, file_path, sink):
+    print(f"Downloading {url}...")
     try:
-        with open(file_path, 'rb') as file:
-            # Check if the file starts with gzip magic number
-            if file.read(2) != b'\x1f\x8b':
-                print(f"File {file_path} is not a valid gzipped file.")
-                return False
-    except Exception as e:
-        print(f"Error validating file {file_path}: {e}")
-        return False
-    return True
+        with session.get(url, headers=_DOWNLOAD_HEADERS,
+                         allow_redirects=True, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            if response.status_code != 200:
+                print(f"Failed to download {url}, Status Code: {response.status_code}")
+                return None
+            
+            # Fail fast if the body is not gzipped, before anything is written
+            response.raw.decode_content = False
+            stream = _peek_gzip_magic(response.raw)
+            if stream is None:
+                print(f"Download from {url} is not a valid gzipped file.")
+                return None
+            
+            # Stream the body straight to disk instead of buffering it in memory
+            with open(file_path, 'wb', buffering=CHUNK_SIZE) as file:
+                sink(stream, file)
+    except (requests.exceptions.RequestException, Urllib3HTTPError) + _GZIP_ERRORS as e:
+        print(f"Failed to download {url}: {e}")
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        return None
+    
+    print(f"Saved {file_path}")
+    return file_path
+
+# Function to download files from URLs, decompressing them on the fly unless unzip is False
+# date_part is the date range used in the filenames, see _date_parts
+def download_files(download_urls, date_part, filename_prefix, unzip=True):
+    if not download_urls:
+        return []
+    
+    sink = _write_unzipped if unzip else _write_gzip
+    extension = ".csv" if unzip else ".csv.gz"
+    
+    # Create a structured filename, numbering the parts when the export is split
+    base_path = os.path.join(REPORT_DIR, f"{filename_prefix}_{date_part}")
+    if len(download_urls) > 1:
+        file_paths = [f"{base_path}_part{i}{extension}" for i in range(1, len(download_urls) + 1)]
+    else:
+        file_paths = [f"{base_path}{extension}"]
+    
+    with ThreadPoolExecutor(max_workers=min(MAX_DOWNLOAD_WORKERS, len(download_urls))) as executor:
+        futures = [executor.submit(_fetch_one, SESSION, url, file_path, sink)
+                   for url, file_path in zip(download_urls, file_paths)]
+        # Collect in submission order so the parts stay in export order
+        return [file_path for file_path in (future.result() for future in futures) if file_path]
 
 # Function to unzip downloaded files
-def unzip_files(file_path, start_date, end_date, filename_prefix):
-    if validate_file(file_path):
-        print(f"Unzipping {file_path}...")
-        try:
-            date_part = f"{start_date[:10]}_{end_date[:10]}"
-            csv_filename = f"{filename_prefix}_{date_part}.csv"
-            output_path = os.path.join(REPORT_DIR, csv_filename)
-            
-            with gzip.open(file_path, 'rb') as f_in:
-                with open(output_path, 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            print(f"Unzipped to {output_path}")
-            return output_path
-        except Exception as e:
-            print(f"Error unzipping {file_path}: {e}")
+def unzip_files(file_path):
+    print(f"Unzipping {file_path}...")
+    try:
+        # Write next to the archive, dropping the .gz extension
+        output_path = file_path[:-len('.gz')]
+        
+        if rapidgzip is not None and os.path.getsize(file_path) >= PARALLEL_GZIP_MIN_SIZE:
+            # Decompress a large archive on every core, copying in chunks that match rapidgzip's
+            with _parallel_gzip_lock, rapidgzip.open(file_path, parallelization=os.cpu_count() or 1) as f_in:
+                with open(output_path, 'wb', buffering=PARALLEL_GZIP_CHUNK_SIZE) as f_out:
+                    shutil.copyfileobj(f_in, f_out, length=PARALLEL_GZIP_CHUNK_SIZE)
+        else:
+            # Use CHUNK_SIZE buffers instead of the 8-16 KiB defaults to cut syscalls and per-chunk overhead
+            with open(file_path, 'rb', buffering=CHUNK_SIZE) as raw_in, _open_gzip(raw_in) as f_in:
+                with open(output_path, 'wb', buffering=CHUNK_SIZE) as f_out:
+                    _copy_readinto(f_in, f_out, _transfer_buffer())
+        print(f"Unzipped to {output_path}")
+        return output_path
+    except Exception as e:
+        print(f"Error unzipping {file_path}: {e}")
     return None
 
-# Process a single time frame for all organizations
-def process_specific_timeframe(orgs, start_date, end_date):
-    print(f"\nProcessing timeframe: {start_date} to {end_date} for {len(orgs)} organizations")
+# Function to name each timeframe's report files by its days, e.g. 2024-11-01_2024-11-30
+# Timeframes that share their days with another one use the full start and end times instead,
+# so their reports can't overwrite each other
+def _date_parts(timeframes):
+    short_parts = {timeframe: f"{timeframe[0][:10]}_{timeframe[1][:10]}" for timeframe in timeframes}
+    counts = {}
+    for date_part in short_parts.values():
+        counts[date_part] = counts.get(date_part, 0) + 1
+    
+    date_parts = {}
+    for (start_date, end_date), date_part in short_parts.items():
+        if counts[date_part] > 1:
+            date_part = f"{start_date}_{end_date}".replace(':', '')
+        date_parts[(start_date, end_date)] = date_part
+    return date_parts
+
+# Download and unzip the report files of a completed export job
+def _download_report(job_status, date_part, timestamp):
+    download_urls = job_status.get('download_urls', [])
+    filename_prefix = f"all_orgs_{timestamp}"
+    
+    if KEEP_GZ:
+        # Keep the compressed archives and unzip them in a second pass
+        downloaded_files = download_files(download_urls, date_part, filename_prefix, unzip=False)
+        csv_files = [csv_file for csv_file in map(unzip_files, downloaded_files) if csv_file]
+    else:
+        # Decompress while downloading; the .csv.gz is never written to disk
+        csv_files = download_files(download_urls, date_part, filename_prefix)
+    
+    for csv_file in csv_files:
+        print(f"\nSuccess! Report is available at: {csv_file}")
+    
+    return csv_files
+
+# Process several time frames for all organizations
+# All export jobs are created up front so CircleCI generates them in parallel, then their status
+# checks are interleaved on one thread and each report is downloaded as soon as its job completes
+def process_timeframes(orgs, timeframes):
+    # Drop repeated timeframes, keeping the requested order
+    timeframes = list(dict.fromkeys(timeframes))
+    date_parts = _date_parts(timeframes)
+    print(f"\nProcessing {len(timeframes)} timeframe(s) for {len(orgs)} organizations")
     
-    # Format org IDs for API request
-    org_id_list = []
-    for org in orgs:
-        if isinstance(org, dict) and 'id' in org:
-            org_id_list.append(org['id'])
-        elif isinstance(org, str):
-            org_id_list.append(org)
+    # Format org IDs for API request, dropping duplicates while keeping the API's order
+    org_id_list = list(dict.fromkeys(
+        org['id'] if isinstance(org, dict) else org
+        for org in orgs
+        if (isinstance(org, dict) and 'id' in org) or isinstance(org, str)
+    ))
     
     if not org_id_list:
         print("No valid organization IDs found.")
@@ -195,59 +503,88 @@ def process_specific_timeframe(orgs, start_date, end_date):
     
     print(f"Requesting usage data for {len(org_id_list)} organizations")
     
-    # Create the usage export job with all organization IDs
-    job_id = create_usage_export_job(PRIMARY_ORG_ID, CIRCLE_TOKEN, start_date, end_date, org_id_list)
+    # Create a usage export job with all organization IDs for each timeframe
+    jobs = {}
+    for start_date, end_date in timeframes:
+        # A failure on one timeframe must not stop the jobs already created for the others
+        try:
+            job_id = create_usage_export_job(PRIMARY_ORG_ID, start_date, end_date, org_id_list)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Request error while creating export job: {e}")
+            job_id = None
+        
+        if not job_id:
+            print(f"Failed to create export job for timeframe {start_date} to {end_date}")
+            continue
+        
+        print(f"Usage export job created with ID: {job_id}")
+        jobs[job_id] = (start_date, end_date)
     
-    if not job_id:
-        print(f"Failed to create export job for timeframe {start_date} to {end_date}")
+    if not jobs:
         return None
     
-    print(f"Usage export job created with ID: {job_id}")
+    # Generate a timestamp for the filenames
+    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
     
-    # Poll for job status
-    max_attempts = 30  # Increased for jobs with many organizations
-    attempt = 0
-    job_state = "processing"
-    
-    while job_state == "processing" and attempt < max_attempts:
-        job_status = check_job_status(PRIMARY_ORG_ID, CIRCLE_TOKEN, job_id)
-        
-        if job_status is None:
-            break
-        
-        job_state = job_status.get('state')
-        print(f"Job state: {job_state} (attempt {attempt+1}/{max_attempts})")
-        
-        if job_state == "processing":
-            wait_time = min(30 * (attempt + 1), 300)  # Progressive backoff, max 5 minutes
-            print(f"Job is still processing. Waiting for {wait_time} seconds before checking again...")
-            time.sleep(wait_time)
-        
-        attempt += 1
+    # Poll for job status, checking immediately since small jobs often finish within seconds
+    attempts = dict.fromkeys(jobs, 0)
+    next_check = dict.fromkeys(jobs, time.monotonic())
+    deadline = time.monotonic() + POLL_TIMEOUT
+    downloads = []
     
-    # Check if the job has completed
-    if job_state == "completed":
-        print("Job has completed. Downloading files...")
-        download_urls = job_status.get('download_urls', [])
-        
-        # Generate a timestamp for the filename
-        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-        
-        downloaded_files = download_files(download_urls, start_date, end_date, f"all_orgs_{timestamp}")
+    with ThreadPoolExecutor(max_workers=min(MAX_DOWNLOAD_JOBS, len(jobs))) as executor:
+        while next_check:
+            wait_time = min(next_check.values()) - time.monotonic()
+            if wait_time > 0:
+                time.sleep(wait_time)
+            
+            now = time.monotonic()
+            for job_id in [job_id for job_id, due in next_check.items() if due <= now]:
+                start_date, end_date = jobs[job_id]
+                try:
+                    job_status, retry_after = check_job_status(PRIMARY_ORG_ID, job_id)
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    print(f"Request error while checking job {job_id}: {e}")
+                    job_status = None
+                attempts[job_id] += 1
+                
+                if job_status is None:
+                    print(f"Giving up on job {job_id} for timeframe {start_date} to {end_date}")
+                    del next_check[job_id]
+                    continue
+                
+                job_state = job_status.get('state')
+                print(f"Job {job_id} ({start_date} to {end_date}) state: {job_state} (attempt {attempts[job_id]})")
+                
+                remaining = deadline - time.monotonic()
+                if job_state == "processing" and remaining > 0:
+                    # Exponential backoff with jitter, with one final check at the deadline
+                    wait_time = min(_poll_delay(attempts[job_id] - 1, retry_after), remaining)
+                    print(f"Job is still processing. Waiting for {wait_time:.1f} seconds before checking again...")
+                    next_check[job_id] = time.monotonic() + wait_time
+                    continue
+                
+                del next_check[job_id]
+                
+                # Check if the job has completed
+                if job_state == "completed":
+                    print(f"Job {job_id} has completed. Downloading files...")
+                    downloads.append(executor.submit(_download_report, job_status,
+                                                     date_parts[(start_date, end_date)], timestamp))
+                else:
+                    print(f"Job {job_id} has finished with state: {job_state}")
+                    if job_state == "processing":
+                        print("Polling time limit reached. Job is still processing.")
         
         csv_files = []
-        for file_path in downloaded_files:
-            csv_file = unzip_files(file_path, start_date, end_date, f"all_orgs_{timestamp}")
-            if csv_file:
-                csv_files.append(csv_file)
-                print(f"\nSuccess! Report is available at: {csv_file}")
-        
-        return csv_files
-    else:
-        print(f"Job has finished with state: {job_state}")
-        if job_state == "processing":
-            print("Max attempts reached. Job is still processing.")
-        return None
+        for future in downloads:
+            csv_files.extend(future.result())
+    
+    return csv_files
+
+# Process a single time frame for all organizations
+def process_specific_timeframe(orgs, start_date, end_date):
+    return process_timeframes(orgs, [(start_date, end_date)])
 
 # Main script execution
 if __name__ == "__main__":
@@ -260,26 +597,38 @@ if __name__ == "__main__":
     if not PRIMARY_ORG_ID:
         exit("Please set PRIMARY_ORG_ID in your environment variables.")
     
-    if not START_DATE or not END_DATE:
+    # START_DATES/END_DATES take precedence and may list several timeframes
+    start_dates = [date.strip() for date in (START_DATES or START_DATE or '').split(',') if date.strip()]
+    end_dates = [date.strip() for date in (END_DATES or END_DATE or '').split(',') if date.strip()]
+    
+    if not start_dates or not end_dates:
         exit("Please set both START_DATE and END_DATE environment variables in the format: 2024-11-01T09:00:00Z")
     
+    if len(start_dates) != len(end_dates):
+        exit("START_DATES and END_DATES must contain the same number of dates.")
+    
     # Validate date format
     try:
-        # Basic validation - just check if they conform to expected pattern
-        if (not START_DATE.endswith('Z') or not END_DATE.endswith('Z') or 
-            len(START_DATE) != 20 or len(END_DATE) != 20):
-            exit("Date format incorrect. Please use the format: 2024-11-01T09:00:00Z")
+        for date in start_dates + end_dates:
+            if not _is_valid_date(date):
+                exit(f"Date format incorrect: {date}. Please use the format: 2024-11-01T09:00:00Z")
         
-        print(f"Generating report for timeframe: {START_DATE} to {END_DATE}")
+        timeframes = list(zip(start_dates, end_dates))
+        for start_date, end_date in timeframes:
+            print(f"Generating report for timeframe: {start_date} to {end_date}")
         
         # Get all organizations on the shared plan
-        orgs = get_shared_orgs(PRIMARY_ORG_ID, CIRCLE_TOKEN)
+        orgs = get_shared_orgs(PRIMARY_ORG_ID)
         
         if not orgs:
             exit("No organizations found on the shared plan. Exiting.")
         
-        # Process the specific timeframe
-        csv_files = process_specific_timeframe(orgs, START_DATE, END_DATE)
+        # Only show the organization table interactively, so batch runs skip the formatting
+        if VERBOSE or sys.stdout.isatty():
+            _print_orgs_table(orgs)
+        
+        # Process the requested timeframes
+        csv_files = process_timeframes(orgs, timeframes)
         
         if not csv_files:
             print("No reports were generated. Please check the errors above.")